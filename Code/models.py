@@ -1,12 +1,90 @@
+import contextlib
+import functools
+import inspect
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import torchmetrics
 import torchvision
 import pytorch_lightning as pl
 from pl_bolts.models.autoencoders import AE
 
 
+def compile_module(module, mode="reduce-overhead"):
+    """
+    Compiles a module in place with torch.compile so that TorchDynamo/Inductor can fuse its ops into fewer kernels.
+    Only the module's forward is swapped out, the module tree and therefore the state dict keys stay the same so that
+    checkpoints load regardless of whether they were trained compiled or not. Does nothing on versions of PyTorch
+    without nn.Module.compile.
+
+    Returns whether the module was compiled, calls to it should then be made within compile_guard.
+    """
+    if not hasattr(module, "compile"):
+        print("nn.Module.compile unavailable, running eagerly")
+        return False
+
+    module.compile(mode=mode)
+    return True
+
+
+def compile_guard(compiled):
+    """
+    Context for calling a module compiled with compile_module. Compilation only happens on the first calls so a failing
+    backend, e.g. Triton on GPUs older than Volta, falls back to eager execution here rather than crashing part way
+    through training. This is scoped to the calls to the module so compile errors elsewhere aren't hidden.
+    """
+    if not compiled:
+        return contextlib.nullcontext()
+
+    import torch._dynamo
+    return torch._dynamo.config.patch(suppress_errors=True)
+
+
+@contextlib.contextmanager
+def _frozen_batch_norm_stats(module):
+    # With track_running_stats off, BatchNorm still normalises with the batch statistics in train mode but leaves its
+    # running statistics alone.
+    batch_norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    original = [m.track_running_stats for m in batch_norms]
+    for m in batch_norms:
+        m.track_running_stats = False
+    try:
+        yield
+    finally:
+        for m, track_running_stats in zip(batch_norms, original):
+            m.track_running_stats = track_running_stats
+
+
+def _recompute_contexts(module):
+    # Contexts for the original forward pass and for the recomputation during the backward pass respectively.
+    return contextlib.nullcontext(), _frozen_batch_norm_stats(module)
+
+
+class CheckpointedSequential(nn.Sequential):
+    """
+    nn.Sequential which doesn't store the intermediate activations of its children during training. They are recomputed
+    in the backward pass instead, trading a bit of extra compute for a lower peak memory so larger batches fit.
+
+    Each child is checkpointed separately. The BatchNorm running statistics are frozen while a child is recomputed so
+    that they still only get one update per training step.
+    """
+    def __init__(self, *args):
+        if "context_fn" not in inspect.signature(checkpoint).parameters:
+            raise RuntimeError("Gradient checkpointing requires PyTorch 2.1 or later")
+
+        super().__init__(*args)
+
+    def forward(self, x):
+        if not (self.training and torch.is_grad_enabled()):
+            return super().forward(x)
+
+        for child in self:
+            x = checkpoint(child, x, use_reentrant=False, context_fn=functools.partial(_recompute_contexts, child))
+
+        return x
+
+
 class SimpleBinaryClassifier(pl.LightningModule):
     """
     This model was chosen to be as simple as possible for two purposes:
@@ -15,7 +93,7 @@ class SimpleBinaryClassifier(pl.LightningModule):
         2. To make it easier to test out the dataflow/workstream in terms of the connections between Google Colab and
             Google Drive when proving it out.
     """
-    def __init__(self, n_in, n_out, activation_fn):
+    def __init__(self, n_in, n_out, activation_fn, compile_model=False):
         super().__init__()
 
         model = [
@@ -25,14 +103,37 @@ class SimpleBinaryClassifier(pl.LightningModule):
 
         self.model = torch.nn.Sequential(*model)
 
-        self.train_accuracy = torchmetrics.Accuracy()
-        self.test_accuracy = torchmetrics.Accuracy()
-        self.val_accuracy = torchmetrics.Accuracy()
+        self.compiled = compile_model and compile_module(self.model)
+
+        # Running (correct, total) counts for the accuracy. These are a lot lighter than a torchmetrics object per stage
+        # as they're only gathered from the other processes once per epoch.
+        for stage in ['train', 'val', 'test']:
+            self.register_buffer(f'{stage}_correct', torch.zeros(()), persistent=False)
+            self.register_buffer(f'{stage}_total', torch.zeros(()), persistent=False)
 
     def forward(self, x):
-        x = self.model(x)
+        with compile_guard(self.compiled):
+            x = self.model(x)
         return x
 
+    def _update_accuracy(self, stage, y_hat, y):
+        # The outputs are regressed towards the 0/1 labels so threshold them at 0.5 like torchmetrics does to get the
+        # predicted class. Match the shape of the labels so the comparison doesn't broadcast.
+        y_pred = (y_hat.detach().view_as(y) >= 0.5).to(y.dtype)
+        correct = (y_pred == y).sum()
+        getattr(self, f'{stage}_correct').add_(correct)
+        getattr(self, f'{stage}_total').add_(y.numel())
+        self.log(f'{stage}_acc_step', correct / y.numel())
+
+    def _log_epoch_accuracy(self, stage):
+        correct = getattr(self, f'{stage}_correct')
+        total = getattr(self, f'{stage}_total')
+        # Sum the counts over the processes before dividing, averaging each process' accuracy would be off whenever they
+        # see a different number of samples.
+        self.log(f'{stage}_acc_epoch', self.all_gather(correct).sum() / self.all_gather(total).sum())
+        correct.zero_()
+        total.zero_()
+
     def training_step(self, batch, batch_idx):
         x, y = batch
         y_hat = self.forward(x)
@@ -40,8 +141,7 @@ class SimpleBinaryClassifier(pl.LightningModule):
         loss = torch.nn.functional.mse_loss(y_hat, y)
         self.log('train_loss', loss, on_step=False, on_epoch=True)
 
-        self.train_accuracy(y_hat, y.type(torch.int))
-        self.log('train_acc_step', self.train_accuracy)
+        self._update_accuracy('train', y_hat, y)
 
         return loss
 
@@ -52,8 +152,7 @@ class SimpleBinaryClassifier(pl.LightningModule):
         loss = torch.nn.functional.mse_loss(y_hat, y)
         self.log('val_loss', loss, on_step=False, on_epoch=True)
 
-        self.val_accuracy(y_hat, y.type(torch.int))
-        self.log('val_acc_step', self.val_accuracy)
+        self._update_accuracy('val', y_hat, y)
 
         return loss
 
@@ -64,22 +163,18 @@ class SimpleBinaryClassifier(pl.LightningModule):
         loss = torch.nn.functional.mse_loss(y_hat, y)
         self.log('test_loss', loss, on_step=False, on_epoch=True)
 
-        # The casting here should really be fixed earlier in terms of when the
-        # data is loaded but this is sufficient to prove things out from the
-        # data flow standpoint.
-        self.test_accuracy(y_hat, y.type(torch.int))
-        self.log('test_acc_step', self.test_accuracy)
+        self._update_accuracy('test', y_hat, y)
 
         return loss
 
     def training_epoch_end(self, outs):
-        self.log('train_acc_epoch', self.train_accuracy)
+        self._log_epoch_accuracy('train')
 
     def validation_epoch_end(self, outs):
-        self.log('val_acc_epoch', self.val_accuracy)
+        self._log_epoch_accuracy('val')
 
     def test_epoch_end(self, outs):
-        self.log('test_acc_epoch', self.test_accuracy)
+        self._log_epoch_accuracy('test')
 
     def configure_optimizers(self):
         optimizer = torch.optim.SGD(self.parameters(), lr=.1)
@@ -91,13 +186,25 @@ class BaselineResnetClassifier(pl.LightningModule):
     Baseline model built on top of a pretrained ResNet50 architecture.
     """
 
-    def __init__(self, num_classes):
+    def __init__(self, num_classes, gradient_checkpointing=False, compile_model=False):
         super().__init__()
 
         # Load, optionally download pre-trained Resnet.
         self.resnet50 = torchvision.models.resnet50(pretrained=True, num_classes = 1000)
+
+        if gradient_checkpointing:
+            # Recompute the activations of each residual stage during the backward pass. The blocks keep the same
+            # indices so the state dict is unchanged.
+            for name in ["layer1", "layer2", "layer3", "layer4"]:
+                stage = getattr(self.resnet50, name)
+                setattr(self.resnet50, name, CheckpointedSequential(*stage))
+
         self.fc = torch.nn.Linear(1000, num_classes)
 
+        # The convolutional backbone is where nearly all of the compute is, so use the more aggressive autotuning there.
+        # This is only worth it for long runs as the autotuning itself takes a while.
+        self.compiled = compile_model and compile_module(self.resnet50, mode="max-autotune")
+
         # Log stuffs.
         self.train_accuracy = torchmetrics.Accuracy()
         self.test_accuracy = torchmetrics.Accuracy()
@@ -106,7 +213,8 @@ class BaselineResnetClassifier(pl.LightningModule):
     def forward(self, x):
         # convert the incoming data to three dimensions for processing due to the RGB expectation of the pre-trained
         # network
-        x = self.resnet50(x.unsqueeze(1).repeat(1, 3, 1, 1))
+        with compile_guard(self.compiled):
+            x = self.resnet50(x.unsqueeze(1).repeat(1, 3, 1, 1))
         x = F.relu(x)
         x = self.fc(x)
 
@@ -1,6 +1,9 @@
 from datetime import datetime
 import timeit
+import functools
 import os
+import subprocess
+import sys
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
@@ -11,20 +14,24 @@ import json
 import optuna
 from torch.utils.data import random_split
 from pytorch_lightning.callbacks import EarlyStopping
-from sklearn.metrics import ConfusionMatrixDisplay, confusion_matrix, roc_auc_score
+from sklearn.metrics import ConfusionMatrixDisplay, roc_auc_score
 import pytorch_lightning as pl
 import torch
 import pandas as pd
 
+# Let the FP32 matmuls (e.g. the final Linear layers) run on tensor cores when they aren't already under autocast.
+if hasattr(torch, "set_float32_matmul_precision"):
+    torch.set_float32_matmul_precision("high")
+
 BASELINE_RESNET_NAME = "Baseline Resnet"
 MEL_AE_NAME = "Mel AE"
 
+_IS_COLAB = 'COLAB_GPU' in os.environ
+
 def init_measurements_path():
     print("Creating measurements path...")
 
-    is_colab = 'COLAB_GPU' in os.environ
-
-    if is_colab:
+    if _IS_COLAB:
         print('Running on Colab')
         measurements_dir = '/content/drive/MyDrive/ECSE-552-FP/Measurements/'
     else:
@@ -73,6 +80,20 @@ def get_datasets(data_dir, dur_seconds, train_split=.8, crop=None, rgb_expand=Fa
     return train_dataset, val_dataset
 
 
+def init_dataloader(dataset, batch_size, shuffle=False, num_workers=0):
+    # Load into pinned memory so that the host to device copies can overlap with the computation. The device count is
+    # checked rather than torch.cuda.is_available() so that CUDA isn't initialised before Lightning sets up the devices.
+    # AudioDataset computes all of the spectrograms up front so fetching a sample is only a list lookup. Background
+    # workers are only worth it for the loaders that are iterated over for several epochs, in which case they're kept
+    # alive between epochs rather than being re-spawned each time.
+    pin_memory = torch.cuda.device_count() > 0
+    if num_workers > 0:
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                          pin_memory=pin_memory, persistent_workers=True, prefetch_factor=4)
+
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, pin_memory=pin_memory)
+
+
 def make_log_filenames(comment):
     now = datetime.now().strftime("%H_%M_%S-")
 
@@ -82,11 +103,28 @@ def make_log_filenames(comment):
     return profiler_filename, plot_filename, now
 
 
-def init_trainer(logger, max_epochs, profiler, early_stopping = True):
+def gpu_supports_bf16():
+    # Native BF16 needs compute capability 8.0 (Ampere) or later, older GPUs only emulate it slowly. Query the driver
+    # through nvidia-smi rather than torch.cuda so that CUDA isn't initialised in this process before Lightning sets up
+    # the devices.
+    try:
+        output = subprocess.run(["nvidia-smi", "--query-gpu=compute_cap", "--format=csv,noheader"],
+                                capture_output=True, text=True, check=True).stdout
+        return all(float(line) >= 8.0 for line in output.split())
+    except (OSError, subprocess.CalledProcessError, ValueError) as error:
+        print(f"Could not query the GPU compute capability, using FP16: {error}")
+        return False
+
+
+def init_trainer(logger, max_epochs, profiler, early_stopping = True,
+                 # Lightning's DDP strategy wraps the non-boundary accumulation steps in model.no_sync() so the gradient
+                 # all-reduce only happens on the step where the optimizer is applied.
+                 accumulate_grad_batches=1,
+                 # The spectrograms are all the same size for a given dataset so let cuDNN benchmark and pick the fastest
+                 # convolution algorithms up front. Turn this off if the input shapes vary as it re-tunes for every shape.
+                 cudnn_benchmark=True):
     print("Initializing trainer...")
 
-    is_colab = 'COLAB_GPU' in os.environ
-
     if early_stopping:
     	callbacks = [EarlyStopping('val_loss'),  
                     pl.callbacks.ModelCheckpoint(
@@ -101,12 +139,29 @@ def init_trainer(logger, max_epochs, profiler, early_stopping = True):
                     mode='min',
                     filename='{epoch:02d}-{val_acc_step:.2f}')]
 
-    if is_colab:
-        trainer = pl.Trainer(gpus=-1, auto_select_gpus=True, callbacks=callbacks,
-                             logger=logger, max_epochs=max_epochs, profiler=profiler)
+    if _IS_COLAB:
+        # Run one process per GPU with DDP rather than the single-process DataParallel style execution. Lightning
+        # injects the DistributedSampler into the dataloaders and all-reduces the gradients over NCCL. Notebooks stick to
+        # a single GPU as the notebook strategies train in child processes, and the metrics DictLogger records there
+        # never make it back to the notebook's copy of the logger.
+        if 'ipykernel' in sys.modules:
+            devices = 1
+            strategy = None
+        else:
+            devices = -1
+            strategy = "ddp" if torch.cuda.device_count() > 1 else None
+
+        # Mixed precision training, Lightning handles the autocasting. BF16 has the same range as FP32 so it doesn't
+        # need a loss scaler, fall back to FP16 on the GPUs which don't support it.
+        precision = "bf16" if gpu_supports_bf16() else 16
+
+        trainer = pl.Trainer(accelerator="gpu", devices=devices, strategy=strategy, replace_sampler_ddp=True,
+                             precision=precision, accumulate_grad_batches=accumulate_grad_batches,
+                             benchmark=cudnn_benchmark, callbacks=callbacks, logger=logger, max_epochs=max_epochs,
+                             profiler=profiler)
     else:
-        trainer = pl.Trainer(callbacks=callbacks,
-                             logger=logger, max_epochs=max_epochs, profiler=profiler)
+        trainer = pl.Trainer(accumulate_grad_batches=accumulate_grad_batches, benchmark=cudnn_benchmark,
+                             callbacks=callbacks, logger=logger, max_epochs=max_epochs, profiler=profiler)
 
     return trainer
 
@@ -144,18 +199,25 @@ def plot_logger_metrics(logger, measurements_path, plot_filename):
 def plot_confusion_matrix(model, model_name, dataset, data_name, batch_size, measurements_path, plot_time):
     print("Generating Confusion Matrices")
     class_names = dataset.dataset.dirs
-    dataloader = DataLoader(dataset, batch_size=batch_size)
+    dataloader = init_dataloader(dataset, batch_size)
 
-    conf_mat = torch.zeros([len(class_names), len(class_names)])
+    num_classes = len(class_names)
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    # Accumulate on the device by counting the (true, predicted) index pairs, only copying back once at the end.
+    conf_mat = torch.zeros([num_classes, num_classes], dtype=torch.long, device=device)
     model.to(device)
-    for batch in dataloader:
-        x, y = batch
-        y_hat = model(x.to(device))
-        # convert the logit to a class prediction
-        y_hat = y_hat.softmax(dim=1)
-        y_hat = y_hat.argmax(dim=1)
-        conf_mat += confusion_matrix(y.cpu(), y_hat.cpu(), labels=list(range(len(class_names))))
+    # No autograd bookkeeping is needed when only evaluating the model
+    with torch.inference_mode():
+        for batch in dataloader:
+            x, y = batch
+            y_hat = model(x.to(device, non_blocking=True))
+            # convert the logit to a class prediction
+            y_hat = y_hat.softmax(dim=1)
+            y_hat = y_hat.argmax(dim=1)
+            flat = y.to(device, non_blocking=True) * num_classes + y_hat
+            conf_mat += torch.bincount(flat, minlength=num_classes * num_classes).view(num_classes, num_classes)
+
+    conf_mat = conf_mat.cpu().float()
 
     title = model_name + "\nConfusion Matrix - " + data_name
     disp = ConfusionMatrixDisplay(conf_mat.numpy(), display_labels=class_names)
@@ -168,10 +230,7 @@ def plot_confusion_matrix(model, model_name, dataset, data_name, batch_size, mea
     conf_mat_df.to_csv(os.path.join(measurements_path, csv_filename))
 
     # Print accuracy
-    corr = 0
-    for i in range(conf_mat.shape[0]):
-      corr += conf_mat[i,i].numpy()
-    acc = (corr/conf_mat.sum()).numpy()
+    acc = (conf_mat.diag().sum() / conf_mat.sum()).item()
     print("Accuracy: "+ str(round(acc*100, 2))+"%")
 
     # normalize the data for another view
@@ -191,31 +250,44 @@ def plot_confusion_matrix(model, model_name, dataset, data_name, batch_size, mea
 
 
 def get_auroc(model, dataset, batch_size):
-    # This is broken and needs to be fixed...
     print("Calculating AUROC")
-    dataloader = DataLoader(dataset, batch_size=batch_size)
+    dataloader = init_dataloader(dataset, batch_size)
     class_names = dataset.dataset.dirs
+    num_classes = len(class_names)
 
-    y_pop_hat = np.zeros([0,3])
-    y_pop_true = np.zeros([0,0], dtype=np.int64)
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     model.to(device)
-    for batch in dataloader:
-        x, y = batch
-        y_hat = model(x.to(device))
-        # convert the logit to a class prediction
-        y_hat = y_hat.softmax(dim=1)
-        # y_hat = y_hat.argmax(dim=1)
-        y_pop_true = np.append(y_pop_true, y.numpy())
-        y_pop_hat = np.append(y_pop_hat, y_hat.detach().numpy())
-
-    auroc = roc_auc_score(y_pop_true, y_pop_hat, labels=class_names, multi_class="ovr")
+
+    # Fill preallocated buffers on the device and only copy them back once at the end, rather than syncing and growing
+    # a numpy array on every batch.
+    num_samples = len(dataset)
+    y_hat_buf = torch.empty(num_samples, num_classes, device=device)
+    y_true_buf = torch.empty(num_samples, dtype=torch.long)
+    idx = 0
+    # No autograd bookkeeping is needed when only evaluating the model
+    with torch.inference_mode():
+        for batch in dataloader:
+            x, y = batch
+            y_hat = model(x.to(device, non_blocking=True))
+            # convert the logit to class probabilities
+            y_hat = y_hat.softmax(dim=1)
+            batch_len = y.shape[0]
+            y_hat_buf[idx:idx + batch_len] = y_hat
+            y_true_buf[idx:idx + batch_len] = y
+            idx += batch_len
+
+    y_pop_hat = y_hat_buf.cpu().numpy()
+    y_pop_true = y_true_buf.numpy()
+
+    auroc = roc_auc_score(y_pop_true, y_pop_hat, labels=list(range(num_classes)), multi_class="ovr")
     print("AUROC = " + str(round(auroc, 4)))
 
 
-def train_model(model, name, train_dataset, val_dataset, max_epoch=5, batch_size=10, early_stopping = True):
-    train_loader = DataLoader(train_dataset, batch_size=batch_size)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size)
+def train_model(model, name, train_dataset, val_dataset, max_epoch=5, batch_size=10, early_stopping = True,
+                accumulate_grad_batches=1, cudnn_benchmark=True):
+    num_workers = min(8, os.cpu_count() or 1)
+    train_loader = init_dataloader(train_dataset, batch_size, shuffle=True, num_workers=num_workers)
+    val_loader = init_dataloader(val_dataset, batch_size, num_workers=num_workers)
 
     measurements_path = init_measurements_path()
     profiler_filename, plot_filename, plot_time = make_log_filenames(name)
@@ -223,10 +295,15 @@ def train_model(model, name, train_dataset, val_dataset, max_epoch=5, batch_size
     logger = DictLogger()
     profiler = pl.profiler.SimpleProfiler(dirpath=measurements_path, filename=profiler_filename)
 
-    trainer = init_trainer(logger, max_epoch, profiler, early_stopping)
+    trainer = init_trainer(logger, max_epoch, profiler, early_stopping, accumulate_grad_batches, cudnn_benchmark)
 
     trainer.fit(model, train_loader, val_loader)
 
+    # The ddp launcher re-runs the script in a process per GPU so every rank gets here, only the first one has the logged
+    # metrics and should write the results.
+    if not trainer.is_global_zero:
+        return logger
+
     if name == BASELINE_RESNET_NAME:
         plot_logger_metrics(logger, measurements_path, plot_filename)
         # plot_confusion_matrix(model, name, train_dataset, "Training", batch_size, measurements_path, plot_time)
@@ -243,9 +320,15 @@ def train_model(model, name, train_dataset, val_dataset, max_epoch=5, batch_size
 
 
 def hp_tuning_voxforge_classifier(data_dir, max_epoch=10, batch_size=10, dur_seconds=5, comment=""):
+    # Only max_t changes how the dataset is built, so build each one once and reuse it across the trials.
+    @functools.lru_cache(maxsize=None)
+    def build_dataset(max_t):
+        return init_dataset(data_dir, max_t)
+
     # Hyperparameter tuning
     def objective(trial):
-        model = BaselineResnetClassifier(num_classes=3)
+        # Not compiled, every trial would pay for the autotuning again with its own batch size and input shape.
+        model = BaselineResnetClassifier(num_classes=3, compile_model=False)
 
         logger = DictLogger()
         checkpoint_callback = pl.callbacks.ModelCheckpoint(
@@ -271,10 +354,7 @@ def hp_tuning_voxforge_classifier(data_dir, max_epoch=10, batch_size=10, dur_sec
         print(f"Preparing and splitting dataset...")
 
         name = "Resnet50 Baseline"
-        start_time = timeit.default_timer()
-        dataset = AudioDataset(data_dir, max_t=max_t)
-        end_time = timeit.default_timer()
-        print("Dataset creation in seconds: ", end_time - start_time)
+        dataset = build_dataset(max_t)
 
         num_samples = len(dataset)
         num_train = np.floor(num_samples * 0.8).astype(int)
@@ -283,8 +363,8 @@ def hp_tuning_voxforge_classifier(data_dir, max_epoch=10, batch_size=10, dur_sec
         train_dataset, val_dataset = torch.utils.data.random_split(dataset, [num_train, num_val],
                                                                    generator=torch.Generator().manual_seed(42))
 
-        train_loader = DataLoader(train_dataset, batch_size=batch_size)
-        val_loader = DataLoader(val_dataset, batch_size=batch_size)
+        train_loader = init_dataloader(train_dataset, batch_size, shuffle=True)
+        val_loader = init_dataloader(val_dataset, batch_size)
 
         hyperparameters = dict(max_t=max_t, batch_size=batch_size)
         trainer.logger.log_hyperparams(hyperparameters)